@@ -0,0 +1,153 @@
+from threading import Thread
+import queue
+import time
+import logging
+
+from database import MESSAGE_TABLE, LAST_UPDATE, message_row
+
+logger = logging.getLogger(__name__)
+
+INSERT_MESSAGE = """
+    INSERT OR IGNORE INTO {} (
+        chat_id,
+        message_id,
+        user_id,
+        message,
+        file_id,
+        filetype,
+        reply_to,
+        sent)
+    VALUES (?,?,?,?,?,?,?,?)
+""".format(MESSAGE_TABLE)
+
+SET_LAST_UPDATE = "INSERT OR REPLACE INTO params VALUES (?, ?)"
+
+# Seconds to wait before retrying a failed batch, doubling up to the max
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30
+# Attempts made at a failed batch once stop() has been called
+STOP_RETRIES = 3
+# Seconds between checks that the writer is still alive while the queue is
+# full
+PUT_TIMEOUT = 1
+
+# Queue sentinel used to stop the writer thread
+_STOP = object()
+
+
+class ArchiveWriter:
+    """Archives messages to the database from a background thread.
+
+    Messages and handled update ids are pushed onto a bounded queue and
+    written in batches on a separate connection. `last_update` is written in
+    the same transaction as the messages that preceded it, so it never
+    advances past a message that hasn't been archived. A batch that fails is
+    retried until it commits before anything after it is written. If the
+    queue is full then `add_message` and `mark_update` block until the writer
+    catches up, so callers must not hold a write transaction on the same
+    database while calling them.
+    """
+
+    def __init__(self, connect, maxsize=1000, batch_size=100):
+        self.connect = connect
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='archive_writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Flush everything queued so far and wait for the writer to exit"""
+        if self._thread is None:
+            return
+        self._stopping = True
+        if self._thread.is_alive():
+            self._put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def add_message(self, message):
+        self._put(('message', message_row(message)))
+
+    def mark_update(self, update_id):
+        self._put(('update', update_id))
+
+    def _put(self, item):
+        # Fail loudly rather than block forever behind a writer that's gone
+        if self._thread is None or not self._thread.is_alive():
+            raise RuntimeError('Archive writer is not running')
+        try:
+            self._queue.put_nowait(item)
+            return
+        except queue.Full:
+            logger.warning('Archive queue full, waiting for writer')
+        while True:
+            try:
+                self._queue.put(item, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                if not self._thread.is_alive():
+                    raise RuntimeError('Archive writer is not running')
+
+    def _next_batch(self):
+        """Block for one item then take whatever else is already queued"""
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        try:
+            conn = self.connect()
+        except Exception:
+            logger.exception('Archive writer failed to connect')
+            return
+        try:
+            running = True
+            while running:
+                batch = self._next_batch()
+                if batch[-1] is _STOP:
+                    batch.pop()
+                    running = False
+                if batch and not self._write_with_retry(conn, batch):
+                    return
+        finally:
+            conn.close()
+
+    def _write_with_retry(self, conn, batch):
+        delay = RETRY_DELAY
+        attempts = 1
+        while not self._write_batch(conn, batch):
+            if self._stopping and attempts >= STOP_RETRIES:
+                # Nothing after this batch gets written either, so
+                # last_update stays behind and the updates are fetched again
+                logger.error('Giving up on archive batch while stopping')
+                return False
+            time.sleep(delay)
+            delay = min(delay*2, MAX_RETRY_DELAY)
+            attempts += 1
+        return True
+
+    def _write_batch(self, conn, batch):
+        rows = [value for kind, value in batch if kind == 'message']
+        update_ids = [value for kind, value in batch if kind == 'update']
+        last_update = max(update_ids) if update_ids else None
+        try:
+            with conn:
+                if rows:
+                    conn.executemany(INSERT_MESSAGE, rows)
+                if last_update is not None:
+                    conn.execute(SET_LAST_UPDATE, (LAST_UPDATE, last_update))
+        except Exception:
+            logger.exception('Failed to archive batch of {} messages, '
+                             'retrying'.format(len(rows)))
+            return False
+        logger.debug('Archived {} messages'.format(len(rows)))
+        return True
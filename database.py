@@ -5,6 +5,8 @@ import logging
 logger = logging.getLogger(__name__)
 
 MESSAGE_TABLE = "messages2"
+# Id of the last update handled, written by the archive writer
+LAST_UPDATE = "last_update"
 
 
 class FileType(IntEnum):
@@ -16,6 +18,26 @@ class FileType(IntEnum):
     Voice = 6
 
 
+def message_row(message):
+    """Convert a telegram message into a row tuple for MESSAGE_TABLE"""
+    user_id = message.from_user.id if message.from_user else None
+    file_id, filetype = None, None
+    if message.sticker:
+        file_id = message.sticker.file_id
+        filetype = FileType.Sticker
+    reply_to = None
+    if message.reply_to_message:
+        reply_to = message.reply_to_message.message_id
+    return (message.chat.id,
+            message.message_id,
+            user_id,
+            message.text or None,
+            file_id,
+            filetype,
+            reply_to,
+            message.date.timestamp())
+
+
 class BoundParameter:
     def __init__(self, database, name, default=None, cast_fn=None):
         self.database = database
@@ -110,6 +132,10 @@ class Database:
     def commit(self):
         return self.conn.commit()
 
+    def snapshot(self):
+        """Make sure everything written so far is in the SQLite file"""
+        return self.conn.commit()
+
     def set_parameter(self, key, value):
         self._param_cache[key] = value
         logger.debug('setting {} = {}'.format(key, value))
@@ -184,29 +210,6 @@ class Database:
                   chain_length)
         self.conn.execute(query, values)
 
-    def add_message(self, message):
-        kwargs = {
-            'chat_id': message.chat.id,
-            'message_id': message.message_id,
-            'sent': message.date.timestamp()
-        }
-        if message.from_user:
-            kwargs['user_id'] = message.from_user.id
-        if message.sticker:
-            kwargs['file_id'] = message.sticker.file_id
-            kwargs['filetype'] = FileType.Sticker
-        if message.reply_to_message:
-            kwargs['reply_to'] = message.reply_to_message.message_id
-        if message.text:
-            kwargs['message'] = message.text
-
-        keys = kwargs.keys()
-        query = "INSERT INTO {} ({}) VALUES ({})".format(
-            MESSAGE_TABLE,
-            ', '.join(keys),
-            ', '.join([':'+key for key in keys]))
-        self.conn.execute(query, kwargs)
-
     def add_link(self, source, response):
         query = """
             INSERT OR REPLACE INTO chains
@@ -0,0 +1,346 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Condition
+from urllib.parse import urlparse, parse_qsl
+import random
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+STALE_SECONDS = 3
+
+
+def sticker_update(chat_id, user_id, file_id, message_id):
+    """Build an update containing a sticker message, minus the update_id"""
+    return {
+        'message': {
+            'message_id': message_id,
+            'chat': {'id': chat_id, 'type': 'group', 'title': str(chat_id)},
+            'from': {'id': user_id, 'is_bot': False,
+                     'first_name': str(user_id)},
+            'sticker': {'file_id': file_id, 'file_unique_id': file_id,
+                        'width': 512, 'height': 512, 'is_animated': False},
+        }
+    }
+
+
+def text_update(chat_id, user_id, text, message_id):
+    """Build an update containing a text message, minus the update_id"""
+    return {
+        'message': {
+            'message_id': message_id,
+            'chat': {'id': chat_id, 'type': 'group', 'title': str(chat_id)},
+            'from': {'id': user_id, 'is_bot': False,
+                     'first_name': str(user_id)},
+            'text': text,
+        }
+    }
+
+
+def random_script(count, rate, chats=5, users=20, stickers=50,
+                  text_chance=0.1):
+    """Generate a script of (delay, update) pairs at roughly `rate` updates
+    per second. Delays are in seconds from the start of the script."""
+    script = []
+    at = 0.0
+    for i in range(count):
+        at += random.expovariate(rate)
+        chat_id = -random.randrange(1, chats+1)
+        user_id = random.randrange(1, users+1)
+        if random.random() < text_chance:
+            update = text_update(chat_id, user_id, 'hello', i)
+        else:
+            file_id = 'sticker{}'.format(random.randrange(stickers))
+            update = sticker_update(chat_id, user_id, file_id, i)
+        script.append((at, update))
+    return script
+
+
+class Stats:
+    def __init__(self):
+        self.released = 0
+        # Fetched by getUpdates. The bot queues these for its dispatcher, so
+        # this says nothing about how many have been handled.
+        self.fetched = 0
+        self.handled = 0
+        self.handled_stickers = 0
+        # Stickers handled too late for the bot to reply to
+        self.stale_stickers = 0
+        self.replies = 0
+        self.rate_limited = 0
+        self.latencies = []
+        self.first_release = None
+        self.last_handled = None
+
+    def updates_per_second(self):
+        if not self.handled or self.last_handled == self.first_release:
+            return 0.0
+        return self.handled / (self.last_handled - self.first_release)
+
+    def stale_rate(self):
+        if not self.handled_stickers:
+            return 0.0
+        return self.stale_stickers / self.handled_stickers
+
+    def latency_percentile(self, pct):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(len(latencies)-1, int(len(latencies)*pct/100))
+        return latencies[index]
+
+    def summary(self):
+        lines = [
+            'updates released: {}'.format(self.released),
+            'updates fetched: {}'.format(self.fetched),
+            'updates handled: {}'.format(self.handled),
+            'updates/sec: {:.1f}'.format(self.updates_per_second()),
+            'stale stickers: {}/{} ({:.1%})'.format(
+                self.stale_stickers, self.handled_stickers,
+                self.stale_rate()),
+            'replies: {}'.format(self.replies),
+            'rate limited requests: {}'.format(self.rate_limited),
+        ]
+        for pct in (50, 90, 99):
+            latency = self.latency_percentile(pct)
+            if latency is not None:
+                lines.append('reply latency p{}: {:.1f}ms'.format(
+                    pct, latency*1000))
+        return '\n'.join(lines)
+
+
+class FakeBotAPI:
+    """A local stand-in for the Telegram Bot API.
+
+    Updates from `script` are released at their scheduled times and served
+    through `getUpdates`. Every request is delayed by `latency` seconds plus
+    up to `jitter` seconds, and send requests fail with a 429 with
+    probability `rate_limit_chance`. Point the bot at `base_url`.
+
+    The bot acknowledges updates through the getUpdates offset as soon as
+    it has fetched them, before its handlers run. So handling is reported
+    from the bot's side by calling `mark_handled`.
+    """
+
+    def __init__(self, script, host='127.0.0.1', port=0, latency=0.0,
+                 jitter=0.0, rate_limit_chance=0.0, retry_after=1):
+        self.script = script
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_chance = rate_limit_chance
+        self.retry_after = retry_after
+        self.stats = Stats()
+        self.finished = False
+
+        self._cond = Condition()
+        self._pending = []
+        self._next_update_id = 1
+        # update_id -> (message date, whether it holds a sticker)
+        self._released = {}
+        self._handled_up_to = 0
+        self._delivered = set()
+        # chat_id -> time the latest sticker in that chat was delivered
+        self._last_delivery = {}
+        self._message_id = 1000000
+
+        api = self
+
+        class Handler(_RequestHandler):
+            server_api = api
+
+        self.httpd = _ThreadingHTTPServer((host, port), Handler)
+        self.base_url = 'http://{}:{}/bot'.format(
+            *self.httpd.server_address[:2])
+
+    def start(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        Thread(target=self._feed, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def mark_handled(self, last_update, now=None):
+        """Record that the bot has handled every update up to last_update"""
+        now = time.time() if now is None else now
+        with self._cond:
+            last_update = min(last_update, self._next_update_id - 1)
+            for update_id in range(self._handled_up_to + 1, last_update + 1):
+                date, is_sticker = self._released[update_id]
+                self.stats.handled += 1
+                if is_sticker:
+                    self.stats.handled_stickers += 1
+                    # The same check on_sticker makes before replying
+                    if now - date > STALE_SECONDS:
+                        self.stats.stale_stickers += 1
+            if last_update > self._handled_up_to:
+                self._handled_up_to = last_update
+                self.stats.last_handled = now
+
+    def all_handled(self):
+        with self._cond:
+            return (self.finished and
+                    self._handled_up_to >= self._next_update_id - 1)
+
+    def _feed(self):
+        start = time.time()
+        for at, update in self.script:
+            delay = start + at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self._cond:
+                now = time.time()
+                update = dict(update, update_id=self._next_update_id)
+                self._next_update_id += 1
+                message = update.get('message')
+                if message:
+                    update['message'] = dict(message, date=int(now))
+                self._pending.append(update)
+                self._released[update['update_id']] = (
+                    int(now), bool(message and 'sticker' in message))
+                self.stats.released += 1
+                if self.stats.first_release is None:
+                    self.stats.first_release = now
+                self._cond.notify_all()
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+
+    def handle(self, method, params):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        handler = getattr(self, 'on_' + method, None)
+        if handler is None:
+            return 404, {'ok': False, 'error_code': 404,
+                         'description': 'Not Found'}
+        return handler(params)
+
+    def _rate_limit(self):
+        if random.random() < self.rate_limit_chance:
+            with self._cond:
+                self.stats.rate_limited += 1
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after {}'.format(
+                    self.retry_after),
+                'parameters': {'retry_after': self.retry_after},
+            }
+        return None
+
+    def _ok(self, result):
+        return 200, {'ok': True, 'result': result}
+
+    def on_getMe(self, params):
+        return self._ok({'id': 1, 'is_bot': True, 'first_name': 'Fake',
+                         'username': 'fake_bot'})
+
+    def on_setWebhook(self, params):
+        return self._ok(True)
+
+    def on_deleteWebhook(self, params):
+        return self._ok(True)
+
+    def on_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.time() + timeout
+        with self._cond:
+            self._confirm(offset)
+            while not self._pending and not self.finished:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            updates = self._pending[:limit]
+            now = time.time()
+            for update in updates:
+                self._on_delivered(update, now)
+        return self._ok(updates)
+
+    def _confirm(self, offset):
+        confirmed = [u for u in self._pending if u['update_id'] < offset]
+        if not confirmed:
+            return
+        self._pending = [u for u in self._pending if u['update_id'] >= offset]
+        self.stats.fetched += len(confirmed)
+
+    def _on_delivered(self, update, now):
+        update_id = update['update_id']
+        if update_id in self._delivered:
+            return
+        self._delivered.add(update_id)
+        message = update.get('message', {})
+        if 'sticker' in message:
+            self._last_delivery[message['chat']['id']] = now
+
+    def _on_send(self, params, content):
+        limited = self._rate_limit()
+        if limited:
+            return limited
+        chat_id = int(params['chat_id'])
+        with self._cond:
+            self._message_id += 1
+            message_id = self._message_id
+            delivered = self._last_delivery.get(chat_id)
+            if delivered is not None:
+                self.stats.latencies.append(time.time() - delivered)
+            self.stats.replies += 1
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': str(chat_id)},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Fake'},
+        }
+        message.update(content)
+        return self._ok(message)
+
+    def on_sendSticker(self, params):
+        return self._on_send(params, {'sticker': {
+            'file_id': params['sticker'], 'file_unique_id': params['sticker'],
+            'width': 512, 'height': 512, 'is_animated': False}})
+
+    def on_sendMessage(self, params):
+        return self._on_send(params, {'text': params.get('text', '')})
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_api = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self._dispatch(url.path, dict(parse_qsl(url.query)))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        if body:
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+        self._dispatch(url.path, params)
+
+    def _dispatch(self, path, params):
+        # Paths look like /bot<token>/<method>
+        method = path.rstrip('/').rsplit('/', 1)[-1]
+        status, result = self.server_api.handle(method, params)
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
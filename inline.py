@@ -0,0 +1,80 @@
+from telegram import InlineQueryResultCachedSticker
+from telegram.ext import InlineQueryHandler, MessageHandler, Filters
+from collections import OrderedDict
+from hashlib import md5
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Handler group used to track which chat each user is active in. It's kept
+# apart from the main groups so it runs alongside the other sticker handlers.
+TRACKING_GROUP = 2
+# Bounds on the LRU caches below, least recently used go first
+MAX_CACHED_SOURCES = 1000
+MAX_TRACKED_USERS = 10000
+
+
+class InlineSuggestions:
+    """Suggests the likely next stickers for a user's chat in inline mode.
+
+    The chat is whichever one the user last sent a sticker in. Suggestions
+    come from Markov's top responses for each source of that chat's chain,
+    and the results built for each source are cached for `ttl` seconds.
+    """
+
+    def __init__(self, markov, limit=10, ttl=5):
+        self.markov = markov
+        self.limit = limit
+        self.ttl = ttl
+        self.user_chats = OrderedDict()
+        # source -> (expiry time, [(file_id, result)])
+        self._cache = OrderedDict()
+
+    def register_handlers(self, dispatcher):
+        dispatcher.add_handler(InlineQueryHandler(self.on_inline_query), 0)
+        dispatcher.add_handler(
+            MessageHandler(Filters.sticker, self.on_sticker), TRACKING_GROUP)
+
+    def on_sticker(self, bot, update):
+        message = update.message
+        if message.from_user:
+            user_id = message.from_user.id
+            self.user_chats[user_id] = message.chat.id
+            self.user_chats.move_to_end(user_id)
+            if len(self.user_chats) > MAX_TRACKED_USERS:
+                self.user_chats.popitem(last=False)
+
+    def on_inline_query(self, bot, update):
+        query = update.inline_query
+        chat_id = self.user_chats.get(query.from_user.id)
+        results = []
+        if chat_id is not None:
+            seen = set()
+            for source in self.markov.chain_sources(chat_id):
+                for file_id, result in self._source_results(source):
+                    if file_id in seen:
+                        continue
+                    seen.add(file_id)
+                    results.append(result)
+                if len(results) >= self.limit:
+                    break
+        query.answer(results[:self.limit], cache_time=self.ttl,
+                     is_personal=True)
+
+    def _source_results(self, source):
+        now = time.monotonic()
+        cached = self._cache.get(source)
+        if cached and cached[0] > now:
+            self._cache.move_to_end(source)
+            return cached[1]
+        results = [
+            (file_id, InlineQueryResultCachedSticker(
+                md5(file_id.encode()).hexdigest(), file_id))
+            for file_id in self.markov.top_responses(source)[:self.limit]
+        ]
+        self._cache[source] = (now + self.ttl, results)
+        self._cache.move_to_end(source)
+        if len(self._cache) > MAX_CACHED_SOURCES:
+            self._cache.popitem(last=False)
+        return results
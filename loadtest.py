@@ -0,0 +1,123 @@
+"""Run the bot end to end against a local fake Bot API and report throughput
+
+The bot is started as a subprocess with a generated config module that
+points it at the fake server, so nothing is sent to Telegram. Updates count
+as handled once the bot's archive writer has committed last_update past
+them, which is polled from the bot's database. Handling times are therefore
+upper bounds, accurate to about POLL_INTERVAL plus the archive writer's lag.
+"""
+from fakeapi import FakeBotAPI, random_script
+from database import LAST_UPDATE
+import subprocess
+import sqlite3
+import argparse
+import tempfile
+import logging
+import time
+import sys
+import os
+
+POLL_INTERVAL = 0.05
+
+CONFIG_TEMPLATE = """\
+TOKEN = '123:fake'
+BASE_URL = {base_url!r}
+DBFILE = {dbfile!r}
+ADMIN_LIST = []
+LOG_LEVEL = {log_level!r}
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000,
+                        help='number of scripted updates')
+    parser.add_argument('--rate', type=float, default=50.0,
+                        help='mean updates released per second')
+    parser.add_argument('--chats', type=int, default=5)
+    parser.add_argument('--stickers', type=int, default=50,
+                        help='number of distinct stickers in the stream')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds added to every API request')
+    parser.add_argument('--jitter', type=float, default=0.05,
+                        help='maximum random seconds added on top of latency')
+    parser.add_argument('--rate-limit-chance', type=float, default=0.01,
+                        help='chance that a send request gets a 429')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='give up after this many seconds')
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+
+def read_last_update(dbfile):
+    """The last update the bot has handled, or None if it isn't known yet"""
+    try:
+        conn = sqlite3.connect('file:{}?mode=ro'.format(dbfile), uri=True)
+    except sqlite3.OperationalError:
+        return None  # The bot hasn't created its database yet
+    try:
+        row = conn.execute("SELECT value FROM params WHERE key = ?",
+                           (LAST_UPDATE,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def wait_for_bot(api, bot, dbfile, timeout=None):
+    """Wait for the bot to handle every update, giving up if it exits"""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        last_update = read_last_update(dbfile)
+        if last_update is not None:
+            api.mark_handled(last_update)
+        if api.all_handled():
+            return True
+        if bot.poll() is not None:
+            print('Bot exited with code {}'.format(bot.returncode))
+            return False
+        if deadline is not None and time.time() > deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+
+
+def main():
+    args = parse_args()
+    script = random_script(args.count, args.rate, chats=args.chats,
+                           stickers=args.stickers)
+    api = FakeBotAPI(script, latency=args.latency, jitter=args.jitter,
+                     rate_limit_chance=args.rate_limit_chance)
+    api.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dbfile = os.path.join(tmp, 'bot.db')
+        with open(os.path.join(tmp, 'config.py'), 'w') as f:
+            f.write(CONFIG_TEMPLATE.format(
+                base_url=api.base_url,
+                dbfile=dbfile,
+                log_level=args.log_level))
+        # Run from the temp dir so its config module is imported instead of
+        # any config.py sitting next to runbot.py
+        here = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, PYTHONPATH=here)
+        runner = 'import runpy; runpy.run_path({!r}, run_name="__main__")'
+        bot = subprocess.Popen(
+            [sys.executable, '-c',
+             runner.format(os.path.join(here, 'runbot.py'))],
+            cwd=tmp, env=env)
+        try:
+            completed = wait_for_bot(api, bot, dbfile, args.timeout)
+        finally:
+            bot.terminate()
+            bot.wait()
+            api.stop()
+
+    if not completed:
+        print('Stopped before every update was handled')
+    print(api.stats.summary())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -1,19 +1,56 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import random
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Most sources to keep a TopK index for, least recently asked for go first
+MAX_TOP_SOURCES = 1000
+
 
 def items_to_key(items):
     return ' '.join(items)
 
 
+class TopK:
+    """The k most common responses to a single source.
+
+    Counts only ever go up, so a response can only enter the top k on its
+    own increment and the list can be kept sorted without rescanning.
+    """
+
+    def __init__(self, k, rows):
+        self.k = k
+        self.counts = dict(rows)
+        self.top = sorted(self.counts, key=self.counts.get, reverse=True)[:k]
+
+    def increment(self, response):
+        count = self.counts.get(response, 0) + 1
+        self.counts[response] = count
+        top = self.top
+        if response in top:
+            i = top.index(response)
+        elif len(top) < self.k:
+            top.append(response)
+            i = len(top) - 1
+        elif count > self.counts[top[-1]]:
+            top[-1] = response
+            i = len(top) - 1
+        else:
+            return
+        while i > 0 and self.counts[top[i-1]] < count:
+            top[i-1], top[i] = top[i], top[i-1]
+            i -= 1
+
+
 class Markov:
-    def __init__(self, database, max_order=2):
+    def __init__(self, database, max_order=2, top_k=10):
         self.db = database
         self.chats = defaultdict(list)
         self.max_order = max_order
+        self.top_k = top_k
+        # source -> TopK, only for recently asked for sources
+        self._top = OrderedDict()
 
     def add_item(self, item, chat_id, add_chain=True):
         chat = self.chats[chat_id]
@@ -26,6 +63,9 @@ class Markov:
                 source = items_to_key(chat[-(order+1):-1])
                 response = chat[-1]
                 self.db.add_link(source, response)
+                top = self._top.get(source)
+                if top is not None:
+                    top.increment(response)
 
         # Trim excess items
         if len(chat) > self.max_order:
@@ -34,13 +74,33 @@ class Markov:
     def break_chain(self, chat_id):
         self.chats.pop(chat_id, None)
 
-    def get_response(self, chat_id):
-        chain = self.chats[chat_id]
-        response = None
+    def _sources(self, chain):
         for i in range(self.max_order, 0, -1):
             if len(chain) < i:
                 continue
-            response = self._calculate_response(items_to_key(chain[-i:]))
+            yield items_to_key(chain[-i:])
+
+    def chain_sources(self, chat_id):
+        """Sources for the chat's current chain, highest order first"""
+        return list(self._sources(self.chats.get(chat_id, [])))
+
+    def top_responses(self, source):
+        """The most common responses to source, most common first"""
+        try:
+            top = self._top[source]
+            self._top.move_to_end(source)
+        except KeyError:
+            top = TopK(self.top_k, self.db.get_response_rows(source))
+            self._top[source] = top
+            if len(self._top) > MAX_TOP_SOURCES:
+                self._top.popitem(last=False)
+        return list(top.top)
+
+    def get_response(self, chat_id):
+        chain = self.chats[chat_id]
+        response = None
+        for source in self._sources(chain):
+            response = self._calculate_response(source)
             if response:
                 break
         return response
@@ -0,0 +1,392 @@
+from database import Database, LAST_UPDATE
+from array import array
+from threading import Thread
+import json
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SEQ = 'snapshot_seq'
+# Parameters written to SQLite by other connections. These are always read
+# from the database rather than kept in memory.
+EXTERNAL_PARAMS = (LAST_UPDATE,)
+
+
+class MemoryDatabase(Database):
+    """Database backend that serves everything from memory.
+
+    The SQLite file is loaded on `initialize` and afterwards only receives
+    periodic snapshots. Every change is appended to a log at `log_path`,
+    which is flushed (and fsynced unless `fsync` is off) on `commit` and
+    replayed on startup, so nothing is lost between snapshots. Parameters
+    in EXTERNAL_PARAMS are written by other connections, so they always go
+    straight to SQLite. Log entries carry a sequence number and the snapshot
+    records the last one it covers, so replaying never applies a change
+    twice.
+
+    Chains are stored as interned integer ids, with a pair of arrays of
+    response ids and counts per source.
+
+    `commit` costs an fsync per call unless `fsync` is off, which trades
+    durability against an OS crash for handler latency. If
+    `snapshot_connect` is given then periodic snapshots run on a background
+    thread with their own connection: the handler only rotates the log and
+    copies the changed rows. Otherwise they run inside `commit`. The log is
+    rotated to `<log_path>.<seq>` and removed once a snapshot covering it
+    has committed.
+    """
+
+    def __init__(self, conn, log_path, snapshot_interval=60, fsync=True,
+                 snapshot_connect=None):
+        super().__init__(conn)
+        self.log_path = log_path
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.snapshot_connect = snapshot_connect
+        self._snapshot_thread = None
+        # Dirty sets taken by a background snapshot that then failed
+        self._failed_dirty = None
+        self._log = None
+        self._seq = 0
+        self._last_snapshot = 0.0
+
+        self._strings = []
+        self._string_ids = {}
+        # source id -> (array of response ids, array of counts)
+        self._chains = {}
+        self._params = {}
+        self._aliases = {}
+        self._chat_states = {}
+
+        self._dirty_sources = set()
+        self._dirty_params = set()
+        self._dirty_aliases = set()
+        self._dirty_states = set()
+
+    def initialize(self):
+        super().initialize()
+        self.conn.commit()
+        self._load()
+        self._replay()
+        self._log = open(self.log_path, 'a')
+        self._last_snapshot = time.time()
+
+    def _load(self):
+        query = "SELECT source, response, count FROM chains"
+        for source, response, count in self.conn.execute(query):
+            responses, counts = self._source_links(self._intern(source))
+            responses.append(self._intern(response))
+            counts.append(count)
+        query = "SELECT key, value FROM params"
+        for key, value in self.conn.execute(query):
+            if key == SNAPSHOT_SEQ:
+                self._seq = value
+            elif key not in EXTERNAL_PARAMS:
+                self._params[key] = value
+        query = "SELECT name, chat_id FROM chat_aliases"
+        self._aliases.update(self.conn.execute(query))
+        query = """
+            SELECT
+                chat_id,
+                messages_since_reply,
+                stickers_since_reply,
+                chain_length
+            FROM chat_states
+        """
+        for row in self.conn.execute(query):
+            self._chat_states[row[0]] = tuple(row[1:])
+        logger.info('Loaded {} chain sources from database'
+                    .format(len(self._chains)))
+
+    def _rotated_logs(self):
+        """(seq, path) of logs handed to background snapshots, oldest first"""
+        directory = os.path.dirname(self.log_path) or '.'
+        prefix = os.path.basename(self.log_path) + '.'
+        logs = []
+        for name in os.listdir(directory):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and suffix.isdigit():
+                logs.append((int(suffix), os.path.join(directory, name)))
+        return sorted(logs)
+
+    def _replay(self):
+        paths = [path for seq, path in self._rotated_logs()]
+        if os.path.exists(self.log_path):
+            paths.append(self.log_path)
+        replayed = sum(self._replay_file(path) for path in paths)
+        logger.info('Replayed {} log entries'.format(replayed))
+
+    def _replay_file(self, path):
+        replayed = 0
+        # End of the last complete entry, so a torn write can be cut off
+        # before anything else is appended after it
+        good_end = 0
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                offset += len(line)
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete entry')
+                    seq, op, *args = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # A torn final write from a crash
+                    logger.warning('Skipping corrupt log entry')
+                    continue
+                good_end = offset
+                if seq <= self._seq:
+                    continue
+                self._seq = seq
+                getattr(self, '_apply_' + op)(*args)
+                replayed += 1
+        if good_end < offset:
+            os.truncate(path, good_end)
+        return replayed
+
+    def _append(self, *entry):
+        self._seq += 1
+        self._log.write(json.dumps((self._seq,) + entry))
+        self._log.write('\n')
+
+    def commit(self):
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        if time.time() - self._last_snapshot >= self.snapshot_interval:
+            if self.snapshot_connect:
+                self._start_background_snapshot()
+            else:
+                self.snapshot()
+
+    def snapshot(self):
+        """Write every change since the last snapshot to SQLite on this
+        thread and clear the logs"""
+        if self._snapshot_thread:
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+        self._log.flush()
+        dirty, rows = self._take_dirty()
+        try:
+            _write_snapshot(self.conn, rows, self._seq)
+        except Exception:
+            self._failed_dirty = dirty
+            raise
+        self._log.truncate(0)
+        self._log.seek(0)
+        self._remove_rotated_logs(self._seq)
+        self._last_snapshot = time.time()
+        logger.debug('Snapshot written at sequence {}'.format(self._seq))
+
+    def _start_background_snapshot(self):
+        if self._snapshot_thread and self._snapshot_thread.is_alive():
+            return
+        self._last_snapshot = time.time()
+        if os.path.getsize(self.log_path) == 0:
+            return  # Nothing has changed
+        # Hand the log so far over to the snapshot and start a new one
+        seq = self._seq
+        self._log.close()
+        os.replace(self.log_path, '{}.{}'.format(self.log_path, seq))
+        self._log = open(self.log_path, 'a')
+        dirty, rows = self._take_dirty()
+        self._snapshot_thread = Thread(target=self._background_snapshot,
+                                       args=(dirty, rows, seq),
+                                       name='snapshot', daemon=True)
+        self._snapshot_thread.start()
+
+    def _background_snapshot(self, dirty, rows, seq):
+        try:
+            conn = self.snapshot_connect()
+            try:
+                _write_snapshot(conn, rows, seq)
+            finally:
+                conn.close()
+        except Exception:
+            # The rotated log stays, and the next snapshot covers these rows
+            logger.exception('Background snapshot failed')
+            self._failed_dirty = dirty
+            return
+        self._remove_rotated_logs(seq)
+        logger.debug('Snapshot written at sequence {}'.format(seq))
+
+    def _remove_rotated_logs(self, seq):
+        for log_seq, path in self._rotated_logs():
+            if log_seq <= seq:
+                os.remove(path)
+
+    def _take_dirty(self):
+        """Copy out the rows changed since the last snapshot and reset the
+        dirty sets. Returns the sets too, to be restored on failure."""
+        if self._failed_dirty:
+            sources, params, aliases, states = self._failed_dirty
+            self._dirty_sources |= sources
+            self._dirty_params |= params
+            self._dirty_aliases |= aliases
+            self._dirty_states |= states
+            self._failed_dirty = None
+        dirty = (self._dirty_sources, self._dirty_params,
+                 self._dirty_aliases, self._dirty_states)
+        rows = (
+            list(self._dirty_links()),
+            [(key, self._params[key]) for key in self._dirty_params],
+            [(name, self._aliases.get(name)) for name in self._dirty_aliases],
+            [(chat_id,) + tuple(self._chat_states[chat_id])
+             for chat_id in self._dirty_states],
+        )
+        self._dirty_sources = set()
+        self._dirty_params = set()
+        self._dirty_aliases = set()
+        self._dirty_states = set()
+        return dirty, rows
+
+    def _dirty_links(self):
+        strings = self._strings
+        for source_id in self._dirty_sources:
+            responses, counts = self._chains[source_id]
+            source = strings[source_id]
+            for response_id, count in zip(responses, counts):
+                yield source, strings[response_id], count
+
+    def _intern(self, string):
+        try:
+            return self._string_ids[string]
+        except KeyError:
+            string_id = len(self._strings)
+            self._strings.append(string)
+            self._string_ids[string] = string_id
+            return string_id
+
+    def _source_links(self, source_id):
+        try:
+            return self._chains[source_id]
+        except KeyError:
+            links = (array('q'), array('q'))
+            self._chains[source_id] = links
+            return links
+
+    def set_parameter(self, key, value):
+        logger.debug('setting {} = {}'.format(key, value))
+        if key in EXTERNAL_PARAMS:
+            query = "INSERT OR REPLACE INTO params VALUES (?, ?)"
+            with self.conn:
+                self.conn.execute(query, (key, value))
+            return
+        self._append('param', key, value)
+        self._apply_param(key, value)
+
+    def _apply_param(self, key, value):
+        if key in EXTERNAL_PARAMS:
+            return
+        self._params[key] = value
+        self._dirty_params.add(key)
+
+    def _get_external_parameter(self, key, default=None):
+        query = "SELECT value FROM params WHERE key = ?"
+        row = self.conn.execute(query, (key,)).fetchone()
+        return row[0] if row else default
+
+    def get_parameter(self, key, default=None):
+        if key in EXTERNAL_PARAMS:
+            return self._get_external_parameter(key, default)
+        try:
+            return self._params[key]
+        except KeyError:
+            self.set_parameter(key, default)
+            return default
+
+    def get_parameters(self):
+        params = dict(self._params)
+        for key in EXTERNAL_PARAMS:
+            value = self._get_external_parameter(key)
+            if value is not None:
+                params[key] = value
+        return sorted(params.items())
+
+    def set_chat_alias(self, name, value):
+        self._append('alias', name, value)
+        self._apply_alias(name, value)
+
+    def delete_chat_alias(self, name):
+        self._append('alias', name, None)
+        self._apply_alias(name, None)
+
+    def _apply_alias(self, name, value):
+        if value is None:
+            self._aliases.pop(name, None)
+        else:
+            self._aliases[name] = value
+        self._dirty_aliases.add(name)
+
+    def get_chat_alias(self, name):
+        return self._aliases.get(name)
+
+    def get_all_chat_aliases(self):
+        return list(self._aliases.items())
+
+    def get_chat_state(self, chat_id):
+        return self._chat_states.get(chat_id)
+
+    def set_chat_state(self, chat_id,
+                       messages_since_reply,
+                       stickers_since_reply,
+                       chain_length):
+        self._append('state', chat_id, messages_since_reply,
+                     stickers_since_reply, chain_length)
+        self._apply_state(chat_id, messages_since_reply,
+                          stickers_since_reply, chain_length)
+
+    def _apply_state(self, chat_id, *state):
+        self._chat_states[chat_id] = state
+        self._dirty_states.add(chat_id)
+
+    def add_link(self, source, response):
+        self._append('link', source, response)
+        self._apply_link(source, response)
+
+    def _apply_link(self, source, response):
+        source_id = self._intern(source)
+        response_id = self._intern(response)
+        responses, counts = self._source_links(source_id)
+        try:
+            i = responses.index(response_id)
+        except ValueError:
+            responses.append(response_id)
+            counts.append(1)
+        else:
+            counts[i] += 1
+        self._dirty_sources.add(source_id)
+
+    def get_response_rows(self, source):
+        source_id = self._string_ids.get(source)
+        if source_id is None or source_id not in self._chains:
+            return []
+        responses, counts = self._chains[source_id]
+        strings = self._strings
+        return [(strings[r], c) for r, c in zip(responses, counts)]
+
+
+def _write_snapshot(conn, rows, seq):
+    links, params, aliases, states = rows
+    with conn:
+        query = "INSERT OR REPLACE INTO chains VALUES (?, ?, ?)"
+        conn.executemany(query, links)
+        query = "INSERT OR REPLACE INTO params VALUES (?, ?)"
+        conn.executemany(query, params)
+        conn.execute(query, (SNAPSHOT_SEQ, seq))
+        query = "DELETE FROM chat_aliases WHERE name = ?"
+        conn.executemany(query, [(name,) for name, chat_id in aliases
+                                 if chat_id is None])
+        query = "INSERT OR REPLACE INTO chat_aliases VALUES (?, ?)"
+        conn.executemany(query, [(name, chat_id) for name, chat_id in aliases
+                                 if chat_id is not None])
+        query = """
+            INSERT OR REPLACE INTO chat_states
+                (chat_id,
+                messages_since_reply,
+                stickers_since_reply,
+                chain_length)
+            VALUES (?,?,?,?)
+        """
+        conn.executemany(query, states)
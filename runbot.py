@@ -1,9 +1,13 @@
 from telegram.ext import Updater, MessageHandler, Filters, BaseFilter, Handler
 from markov import Markov
-from database import Database
+from database import Database, LAST_UPDATE
+from memdatabase import MemoryDatabase
+from archive import ArchiveWriter
 from datetime import datetime
 from admin import Admin
+from inline import InlineSuggestions
 from chatstates import ChatStates
+from trending import Trending
 import botmentions
 import config
 import sqlite3
@@ -16,6 +20,8 @@ database = None
 markov = None
 updater = None
 chat_states = None
+archive = None
+trending = None
 
 
 class AllUpdateHandler(Handler):
@@ -33,6 +39,7 @@ def on_sticker(bot, update):
     sticker_id = message.sticker.file_id
 
     markov.add_item(sticker_id, chat_id)
+    trending.add_item(sticker_id, chat_id)
     state = chat_states[chat_id]
     state.on_sticker()
 
@@ -42,6 +49,8 @@ def on_sticker(bot, update):
 
     if state.should_reply():
         sticker = markov.get_response(chat_id)
+        if not sticker:
+            sticker = trending.sample(chat_id, exclude=sticker_id)
         if sticker:
             state.on_reply()
             bot.send_sticker(chat_id=chat_id, sticker=sticker)
@@ -59,13 +68,17 @@ def on_message(bot, update):
 
 
 def on_post_message(bot, update):
-    database.add_message(update.message)
-    on_post_update(bot, update)
+    on_post_update(bot, update, update.message)
 
 
-def on_post_update(bot, update):
-    database.set_parameter('last_update', update.update_id)
+def on_post_update(bot, update, message=None):
+    # Commit before queueing anything. A full queue blocks until the archive
+    # writer catches up, and it can't while we hold the write lock. This also
+    # means last_update never gets ahead of our changes.
     database.commit()
+    if message:
+        archive.add_message(message)
+    archive.mark_update(update.update_id)
 
 
 def on_error(bot, update, error):
@@ -77,33 +90,57 @@ def main():
     global markov
     global updater
     global chat_states
+    global archive
+    global trending
     # This is safe as long as we only access the db within the dispatcher
     # callbacks. If not then we need locks.
-    database = Database(sqlite3.connect(config.DBFILE, check_same_thread=False))
+    conn = sqlite3.connect(config.DBFILE, check_same_thread=False)
+    if getattr(config, 'DB_BACKEND', 'sqlite') == 'memory':
+        database = MemoryDatabase(
+            conn, config.DBFILE + '.log',
+            fsync=getattr(config, 'DB_FSYNC', True),
+            snapshot_connect=lambda: sqlite3.connect(config.DBFILE, timeout=30))
+    else:
+        database = Database(conn)
     database.initialize()
     markov = Markov(database)
     chat_states = ChatStates(database)
-    updater = Updater(config.TOKEN)
-
-    updater.last_update_id = database.get_parameter('last_update', -1)+1
+    trending = Trending(database)
+    # BASE_URL is optional and lets the bot talk to a stand-in API server
+    updater = Updater(config.TOKEN,
+                      base_url=getattr(config, 'BASE_URL', None))
+    # The dispatcher connection can hold the write lock for a whole update,
+    # including network calls, so give the writer plenty of time to wait
+    archive = ArchiveWriter(lambda: sqlite3.connect(config.DBFILE, timeout=30))
+
+    updater.last_update_id = database.get_parameter(LAST_UPDATE, -1)+1
+    # From here on last_update is only written by the archive writer, so make
+    # sure a freshly created default can't overwrite it later
+    database.snapshot()
 
     admin = Admin(database, markov, updater, chat_states, config.ADMIN_LIST)
 
     dp = updater.dispatcher
 
     admin.register_handlers(dp)
+    InlineSuggestions(markov).register_handlers(dp)
     dp.add_handler(MessageHandler(Filters.sticker, on_sticker), 0)
     dp.add_handler(MessageHandler(Filters.all, on_message), 0)
 
-    # Commit updates after being handled. This avoids messages being handled
-    # twice or updates being missed
+    # Commit updates after being handled so none are missed. Handling is
+    # at-least-once: changes are committed before the archive writer advances
+    # last_update, so a crash in between handles those updates again on
+    # restart and their links get counted twice.
     dp.add_handler(MessageHandler(Filters.all, on_post_message), 1)
     dp.add_handler(AllUpdateHandler(on_post_update), 1)
 
     dp.add_error_handler(on_error)
 
+    archive.start()
     updater.start_polling()
     updater.idle()
+    archive.stop()
+    database.snapshot()
     os._exit(0)
 
 
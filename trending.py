@@ -0,0 +1,104 @@
+from collections import Counter
+import random
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+NUM_BUCKETS = 12
+# Distinct items counted per bucket. Anything new beyond this is ignored
+# until the bucket is recycled.
+MAX_BUCKET_ITEMS = 200
+
+
+class WindowCounter:
+    """Counts items seen over a sliding window of time.
+
+    The window is split into a ring of buckets. Adding an item only touches
+    the current bucket and the running totals, and a bucket's counts are
+    subtracted from the totals once when it falls out of the window.
+    """
+
+    def __init__(self, window):
+        self.buckets = [Counter() for _ in range(NUM_BUCKETS)]
+        self.totals = Counter()
+        self._set_window(window)
+
+    def _set_window(self, window):
+        self.window = window
+        self.bucket_width = max(window, 1) / NUM_BUCKETS
+        self.epoch = None
+        for bucket in self.buckets:
+            bucket.clear()
+        self.totals.clear()
+
+    def advance(self, now, window):
+        if window != self.window:
+            self._set_window(window)
+        epoch = int(now / self.bucket_width)
+        if self.epoch is None:
+            self.epoch = epoch
+            return
+        # Recycle every bucket that has fallen out of the window
+        for old in range(max(self.epoch+1, epoch-NUM_BUCKETS+1), epoch+1):
+            bucket = self.buckets[old % NUM_BUCKETS]
+            for item, count in bucket.items():
+                remaining = self.totals[item] - count
+                if remaining > 0:
+                    self.totals[item] = remaining
+                else:
+                    del self.totals[item]
+            bucket.clear()
+        self.epoch = max(self.epoch, epoch)
+
+    def add(self, item):
+        bucket = self.buckets[self.epoch % NUM_BUCKETS]
+        if item not in bucket and len(bucket) >= MAX_BUCKET_ITEMS:
+            return
+        bucket[item] += 1
+        self.totals[item] += 1
+
+    def sample(self, exclude=None):
+        items = [item for item in self.totals if item != exclude]
+        if not items:
+            return None
+        weights = [self.totals[item] for item in items]
+        return random.choices(items, weights)[0]
+
+
+class Trending:
+    """Recently popular stickers for each chat and across all chats"""
+
+    def __init__(self, database):
+        self.window = database.bound_parameter('trending_window', 3600, int)
+        self.chats = {}
+        self.all_chats = WindowCounter(self.window.get())
+
+    def _counter(self, chat_id):
+        try:
+            return self.chats[chat_id]
+        except KeyError:
+            counter = WindowCounter(self.window.get())
+            self.chats[chat_id] = counter
+            return counter
+
+    def add_item(self, item, chat_id):
+        now = time.time()
+        window = self.window.get()
+        for counter in (self._counter(chat_id), self.all_chats):
+            counter.advance(now, window)
+            counter.add(item)
+
+    def sample(self, chat_id, exclude=None):
+        """Pick a trending item for the chat, falling back to the global
+        index if the chat has nothing apart from `exclude`"""
+        now = time.time()
+        window = self.window.get()
+        for counter in (self.chats.get(chat_id), self.all_chats):
+            if counter is None:
+                continue
+            counter.advance(now, window)
+            item = counter.sample(exclude)
+            if item:
+                return item
+        return None